@@ -1,25 +1,70 @@
 import os
+import re
+import glob
+import time
+import uuid
+import queue
+import tempfile
+import threading
 import streamlit as st
-import urllib.request
+from streamlit.delta_generator import DeltaGenerator
+import requests
 import json
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import List, Optional, Literal, Dict, Any
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from openai import OpenAI
 
+try:
+    import orjson  # optional: faster JSON encoding for webhook logs
+except ImportError:
+    orjson = None
+
 # -----------------------------
 # Configuration
 # -----------------------------
 DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 REASONING_EFFORT = os.getenv("OPENAI_REASONING_EFFORT", "low")
+SCAN_TIMEOUT_SECONDS = 30  # overall deadline for a background scan
+SCAN_POLL_SECONDS = 0.5  # longest single wait, so reruns stay responsive
+# Streamed deltas per UI update: starts at 1 so the first token shows at once,
+# then grows to cut websocket traffic; a flush also happens after a time limit
+STREAM_FLUSH_SIZES = (1, 3, 9, 25)
+STREAM_FLUSH_SECONDS = 0.1
+MESSAGE_WINDOW = 50  # messages rendered individually; older ones are collapsed
+SESSION_DIR = os.getenv("SESSION_DIR", tempfile.gettempdir())
+SESSION_MAX_AGE_SECONDS = 7 * 24 * 3600  # saved sessions untouched this long are deleted
+PERSISTED_KEYS = ("messages", "prev_response_id", "tool_state", "blueprint_md")
+
+# Streamlit re-executes this script on every rerun, so the pool is cached
+# per process instead of being rebuilt (and leaking threads) each time.
+# Module-level factories run before st.set_page_config, so none of them may
+# draw a cache spinner (that would be an earlier st.* call).
+@st.cache_resource(show_spinner=False)
+def _get_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=2)
+
+_EXECUTOR = _get_executor()
+
+# One client per process so calls reuse its keep-alive connection pool.
+# No spinner: it is also fetched from the scan worker thread, which has no
+# ScriptRunContext to draw one in.
+@st.cache_resource(show_spinner=False)
+def get_openai_client() -> OpenAI:
+    return OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), timeout=30.0, max_retries=2)
 
 # -----------------------------
 # Access Gate (protect API spend)
 # -----------------------------
 ACCESS_CODE = os.getenv("ACCESS_CODE", "")
-if ACCESS_CODE:
+if ACCESS_CODE and not st.session_state.get("unlocked"):
     code = st.text_input("Access code", type="password")
     if code != ACCESS_CODE:
         st.stop()
+    # Remember the unlock so later reruns skip the widget entirely
+    st.session_state.unlocked = True
+    st.rerun()
 
 # -----------------------------
 # Structured output schema
@@ -27,6 +72,9 @@ if ACCESS_CODE:
 Mode = Literal["DISCOVERY", "INTENT_LOCK", "BUILDER"]
 
 class ToolState(BaseModel):
+    # Rebuilt from a plain dict in session state every turn; tolerate stale keys
+    model_config = ConfigDict(extra="ignore", validate_assignment=False)
+
     mode: Mode = "DISCOVERY"
     convergence_ready: bool = False
     confidence: Dict[str, int] = Field(default_factory=dict)
@@ -41,102 +89,190 @@ class ToolResponse(BaseModel):
 class Critique(BaseModel):
     issues: List[str] = Field(default_factory=list)
 
+# Strict structured-output format for Critique, built once. responses.parse
+# re-derives this from the model on every call.
+_CRITIQUE_SCHEMA = {
+    **Critique.model_json_schema(),
+    "required": list(Critique.model_fields),  # strict mode: every field
+    "additionalProperties": False,
+}
+_CRITIQUE_TEXT_FORMAT = {
+    "type": "json_schema",
+    "name": "Critique",
+    "schema": _CRITIQUE_SCHEMA,
+    "strict": True,
+}
+
 # -----------------------------
 # System instructions (HARDENED)
 # -----------------------------
 SYSTEM_INSTRUCTIONS = """
-You are an AI reasoning system that helps users turn vague business ideas into a clear, execution-ready business blueprint.
-
-NON-NEGOTIABLE BEHAVIOR
-- This is not a test or exam. You choose the best conversational path to reach clarity.
-- The user may be inarticulate. Do not ask them to explain better. Offer interpretations to react to.
-- Use a recognition loop: Propose → Contrast → Invite rejection → Refine.
-- Avoid hedging. Never use: maybe, might, seems, possibly, could be.
-- Ask at most ONE question per turn.
-
-ASSUMPTION BOUNDARY (CRITICAL)
-- Never present inferred information as fact.
-- Label information explicitly as:
-  (a) Confirmed (from user),
-  (b) Assumed (your inference),
-  (c) Open (WIP).
-
-PROHIBITIONS
-- Do NOT fabricate numbers, market sizes, competitors, pricing benchmarks, regulations, or best practices.
-- If examples are used, keep them generic and label them as examples.
-
-CONVERGENCE RULE
-- Converge when signal is sufficient, not complete:
-  (a) Direction stabilizes,
-  (b) At least one real trade-off is accepted,
-  (c) Emotional confirmation appears.
-- When ready, set state.mode = "INTENT_LOCK".
-
-INTENT_LOCK MODE
-- Output 5–8 declarative sentences describing the business.
-- No bullets, no frameworks, no hedging.
-- Then ask exactly one question:
-  "If we proceed on this basis, I will now design the full business blueprint. Is there anything here that feels fundamentally wrong or missing?"
-
-BUILDER MODE
-- Stop exploring. Synthesize decisively.
-- Produce a Markdown blueprint with these sections:
-  1. Business summary
-  2. Customer and problem
-  3. Value proposition and differentiation
-  4. Product scope (MVP, included vs excluded)
-  5. Go-to-market hypothesis
-  6. Tech and build direction
-  7. Operations and risks
-  8. Revenue and pricing logic
-  9. 90-day execution plan
-  10. Open items (WIP, mandatory)
-  11. Reality checks & risks
-- Explicitly tag assumptions and open items.
-
-OUTPUT FORMAT
-Return valid JSON matching the ToolResponse schema.
+Role: turn a vague business idea into a clear, execution-ready business blueprint.
+
+RULES
+- Conversation, not a test; you pick the path to clarity.
+- User may be inarticulate: offer interpretations to react to, never ask them to explain better.
+- Loop: Propose → Contrast → Invite rejection → Refine.
+- No hedging (maybe, might, seems, possibly, could be).
+- Max ONE question per turn.
+- Label every claim: Confirmed (user) / Assumed (your inference) / Open (WIP). Never state inference as fact.
+- Never fabricate numbers, market sizes, competitors, pricing benchmarks, regulations, or best practices. Examples: generic, labelled.
+
+CONVERGE when signal is sufficient, not complete: direction stable, one real trade-off accepted, emotional confirmation. Then state.mode = "INTENT_LOCK".
+
+INTENT_LOCK: 5–8 declarative sentences describing the business. No bullets, no frameworks, no hedging. Then ask exactly:
+"If we proceed on this basis, I will now design the full business blueprint. Is there anything here that feels fundamentally wrong or missing?"
+
+BUILDER: stop exploring, synthesize decisively. Markdown blueprint, sections:
+1. Business summary 2. Customer and problem 3. Value proposition and differentiation 4. Product scope (MVP, included vs excluded) 5. Go-to-market hypothesis 6. Tech and build direction 7. Operations and risks 8. Revenue and pricing logic 9. 90-day execution plan 10. Open items (WIP, mandatory) 11. Reality checks & risks
+Tag assumptions and open items.
+
+OUTPUT: valid JSON matching the ToolResponse schema.
 """
 
 # -----------------------------
 # Helper: contradiction scan
 # -----------------------------
+# Cached on the blueprint text so an unchanged blueprint is never re-scanned
+@st.cache_data(show_spinner=False, ttl=3600)
 def run_contradiction_scan(blueprint_md: str) -> List[str]:
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    resp = client.responses.parse(
+    client = get_openai_client()
+    resp = client.responses.create(
         model=DEFAULT_MODEL,
         reasoning={"effort": REASONING_EFFORT},
         input=[
             {"role": "system", "content": "Scan for internal contradictions, unrealistic assumptions, or logic mismatches. List only concrete issues."},
             {"role": "user", "content": blueprint_md},
         ],
-        text_format=Critique,
+        text={"format": _CRITIQUE_TEXT_FORMAT},
     )
-    return resp.output_parsed.issues
-    
-def log_to_gsheet(role: str, message: str):
-    url = os.environ.get("GSHEET_WEBHOOK_URL")
-    if not url:
-        return  # logging is optional
-
-    payload = {
-        "timestamp_utc": __import__("datetime").datetime.utcnow().isoformat(),
+    if not resp.output_text:
+        # Refusals carry no output_text; the merge reports the check as unavailable
+        raise ValueError("Contradiction scan returned no output")
+    return Critique.model_validate_json(resp.output_text).issues
+
+CONSISTENCY_HEADING = "## Consistency check (auto)"
+
+def submit_scan(blueprint_md: str):
+    # Scan in the background; the result is merged on a later rerun
+    st.session_state.pending_scan = _EXECUTOR.submit(run_contradiction_scan, blueprint_md)
+    st.session_state.scan_deadline = time.monotonic() + SCAN_TIMEOUT_SECONDS
+
+def append_consistency_check(blueprint_md: str, issues: List[str]) -> str:
+    blueprint_md += f"\n\n{CONSISTENCY_HEADING}\n"
+    if issues:
+        for i, issue in enumerate(issues, 1):
+            blueprint_md += f"{i}. {issue}\n"
+    else:
+        blueprint_md += "No internal contradictions detected.\n"
+    return blueprint_md
+
+def append_consistency_check_unavailable(blueprint_md: str) -> str:
+    return blueprint_md + f"\n\n{CONSISTENCY_HEADING}\nConsistency check unavailable.\n"
+
+def set_blueprint(blueprint_md: str):
+    # Encode once here rather than on every rerun of the download button
+    st.session_state.blueprint_md = blueprint_md
+    st.session_state.blueprint_md_bytes = blueprint_md.encode()
+
+def _json_bytes(payload: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode("utf-8")
+
+@st.cache_resource(show_spinner=False)
+def get_log_session() -> requests.Session:
+    return requests.Session()
+
+def _log_worker(log_q: queue.Queue, session: requests.Session):
+    while True:
+        url, payload = log_q.get()
+        try:
+            data = _json_bytes(payload)
+            session.post(
+                url,
+                data=data,
+                headers={"Content-Type": "application/json"},
+                timeout=3,
+            )
+        except Exception:
+            # Never break the app because logging failed
+            pass
+
+# One queue + daemon worker per process; logging never blocks a rerun
+@st.cache_resource(show_spinner=False)
+def _get_log_queue() -> queue.Queue:
+    log_q = queue.Queue()
+    threading.Thread(target=_log_worker, args=(log_q, get_log_session()), daemon=True).start()
+    return log_q
+
+_LOG_Q = _get_log_queue()
+
+def make_log_entry(role: str, message: str) -> Dict[str, Any]:
+    return {
+        "timestamp_utc": datetime.now(timezone.utc).isoformat(),
         "session_id": st.session_state.get("session_id", ""),
         "role": role,
         "message": message,
     }
 
+def log_batch_to_gsheet(entries: List[Dict[str, Any]]):
+    url = os.environ.get("GSHEET_WEBHOOK_URL")
+    if not url:
+        return  # logging is optional
+
+    # One POST per batch; the webhook appends all rows at once
+    _LOG_Q.put_nowait((url, {"entries": entries}))
+
+# -----------------------------
+# Helper: session persistence (survives a tab refresh via ?sid=)
+# -----------------------------
+def _session_path(session_id: str) -> str:
+    return os.path.join(SESSION_DIR, f"blueprint_session_{session_id}.json")
+
+def load_session(session_id: str) -> bool:
+    # The id comes from the URL, so only accept ids this app could have issued
+    if not re.fullmatch(r"[0-9a-f]{32}", session_id):
+        return False
     try:
-        data = json.dumps(payload).encode("utf-8")
-        req = urllib.request.Request(
-            url,
-            data=data,
-            headers={"Content-Type": "application/json"},
-            method="POST",
-        )
-        urllib.request.urlopen(req, timeout=3).read()
-    except Exception:
-        # Never break the app because logging failed
+        with open(_session_path(session_id), encoding="utf-8") as f:
+            data = json.load(f)
+        saved = {k: data[k] for k in PERSISTED_KEYS}
+    except (OSError, ValueError, KeyError):
+        return False
+
+    set_blueprint(saved.pop("blueprint_md"))
+    for k, v in saved.items():
+        st.session_state[k] = v
+    return True
+
+def save_session():
+    data = {k: st.session_state[k] for k in PERSISTED_KEYS}
+    path = _session_path(st.session_state.session_id)
+    try:
+        # Transcripts are private: owner-only permissions, even in a shared temp dir
+        fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        # Persistence is best-effort; the live session keeps working
+        pass
+
+def prune_sessions():
+    # Abandoned tabs never hit Reset, so expire their files by age
+    cutoff = time.time() - SESSION_MAX_AGE_SECONDS
+    for path in glob.glob(os.path.join(SESSION_DIR, "blueprint_session_*")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def delete_session():
+    try:
+        os.remove(_session_path(st.session_state.session_id))
+    except OSError:
         pass
 
 # -----------------------------
@@ -151,16 +287,54 @@ st.info(
     "Validate them before execution."
 )
 
+if "session_id" not in st.session_state:
+    # Reconnect to a saved session (and its OpenAI response chain) on refresh
+    prune_sessions()
+    sid = st.query_params.get("sid", "")
+    if not load_session(sid):
+        sid = uuid.uuid4().hex
+        st.query_params["sid"] = sid
+    st.session_state.session_id = sid
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "session_id" not in st.session_state:
-    st.session_state.session_id = os.urandom(4).hex()
 if "prev_response_id" not in st.session_state:
     st.session_state.prev_response_id = None
 if "tool_state" not in st.session_state:
-    st.session_state.tool_state = ToolState().model_dump()
+    st.session_state.tool_state = ToolState().model_dump(mode="python")
 if "blueprint_md" not in st.session_state:
     st.session_state.blueprint_md = ""
+    st.session_state.blueprint_md_bytes = b""
+if "pending_scan" not in st.session_state:
+    st.session_state.pending_scan = None
+    # A refresh mid-scan drops the future; re-run the check for a restored
+    # Builder blueprint that never got it (a cache hit if it already finished)
+    if (
+        st.session_state.tool_state.get("mode") == "BUILDER"
+        and st.session_state.blueprint_md
+        and CONSISTENCY_HEADING not in st.session_state.blueprint_md
+    ):
+        submit_scan(st.session_state.blueprint_md)
+
+# Merge a finished background contradiction scan into the blueprint
+if (
+    st.session_state.pending_scan
+    and not st.session_state.pending_scan.done()
+    and time.monotonic() > st.session_state.scan_deadline
+):
+    # Past the deadline: stop waiting (the worker thread finishes on its own)
+    st.session_state.pending_scan = None
+    set_blueprint(append_consistency_check_unavailable(st.session_state.blueprint_md))
+    save_session()
+if st.session_state.pending_scan and st.session_state.pending_scan.done():
+    scan, st.session_state.pending_scan = st.session_state.pending_scan, None
+    try:
+        issues = scan.result()
+    except Exception:
+        # The scan is a background extra; never let it take down the page
+        set_blueprint(append_consistency_check_unavailable(st.session_state.blueprint_md))
+    else:
+        set_blueprint(append_consistency_check(st.session_state.blueprint_md, issues))
+    save_session()
 
 # Sidebar
 with st.sidebar:
@@ -168,30 +342,25 @@ with st.sidebar:
     st.write("Mode:", st.session_state.tool_state.get("mode"))
     st.write("Converged:", st.session_state.tool_state.get("convergence_ready"))
     if st.button("Reset"):
+        delete_session()  # a discarded conversation must not reopen from an old ?sid= URL
         st.session_state.clear()
+        st.query_params.clear()  # start a new saved session, not reload this one
         st.rerun()
 
-# Show conversation
-for m in st.session_state.messages:
-    with st.chat_message(m["role"]):
-        st.markdown(m["content"])
-
-# Chat input
-user_input = st.chat_input(st.session_state.tool_state.get("next_user_prompt", "Describe your idea."))
+def call_ai(user_text: str, placeholder: DeltaGenerator) -> ToolResponse:
+    client = get_openai_client()
 
-def call_ai(user_text: str) -> ToolResponse:
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-
-    # Use previous_response_id for continuity if available
+    # The system prompt is sent once, as the first input item of the thread.
+    # Top-level `instructions` are not carried over by previous_response_id,
+    # whereas input items are, so follow-up turns only send the user message.
     if st.session_state.prev_response_id:
-        resp = client.responses.create(
+        stream_ctx = client.responses.stream(
             model=DEFAULT_MODEL,
             previous_response_id=st.session_state.prev_response_id,
-            instructions=SYSTEM_INSTRUCTIONS,
             input=[{"role": "user", "content": user_text}],
         )
     else:
-        resp = client.responses.create(
+        stream_ctx = client.responses.stream(
             model=DEFAULT_MODEL,
             input=[
                 {"role": "system", "content": SYSTEM_INSTRUCTIONS},
@@ -199,14 +368,31 @@ def call_ai(user_text: str) -> ToolResponse:
             ],
         )
 
+    # Stream deltas into the placeholder, buffered into growing batches
+    chunks: List[str] = []
+    pending, flushes, last_flush = 0, 0, time.monotonic()
+    with stream_ctx as stream:
+        for event in stream:
+            if event.type != "response.output_text.delta":
+                continue
+            chunks.append(event.delta)
+            pending += 1
+            batch = STREAM_FLUSH_SIZES[min(flushes, len(STREAM_FLUSH_SIZES) - 1)]
+            now = time.monotonic()
+            if pending >= batch or now - last_flush >= STREAM_FLUSH_SECONDS:
+                placeholder.markdown("".join(chunks))
+                pending, flushes, last_flush = 0, flushes + 1, now
+        resp = stream.get_final_response()
+    if pending:
+        placeholder.markdown("".join(chunks))
+
     # Persist response id (so the thread continues)
     st.session_state.prev_response_id = resp.id
 
-    # Manual text extraction (robust)
-    assistant_text = resp.output_text or ""
+    assistant_text = "".join(chunks)
 
     # For v0 testing, keep state as-is (no schema-based routing yet)
-    current_state = ToolState(**st.session_state.tool_state)
+    current_state = ToolState.model_validate(st.session_state.tool_state)
 
     return ToolResponse(
         assistant_message=assistant_text,
@@ -214,32 +400,49 @@ def call_ai(user_text: str) -> ToolResponse:
         blueprint_md=None,
     )
 
-
-if user_input:
-    st.session_state.messages.append({"role": "user", "content": user_input})
-    log_to_gsheet("user", user_input)
-    with st.chat_message("user"):
-        st.markdown(user_input)
-
-    parsed = call_ai(user_input)
-    st.session_state.tool_state = parsed.state.model_dump()
-
-    if parsed.blueprint_md:
-        bp = parsed.blueprint_md
-        if st.session_state.tool_state.get("mode") == "BUILDER":
-            issues = run_contradiction_scan(bp)
-            bp += "\n\n## Consistency check (auto)\n"
-            if issues:
-                for i, issue in enumerate(issues, 1):
-                    bp += f"{i}. {issue}\n"
-            else:
-                bp += "No internal contradictions detected.\n"
-        st.session_state.blueprint_md = bp
-
-    st.session_state.messages.append({"role": "assistant", "content": parsed.assistant_message})
-    log_to_gsheet("assistant", parsed.assistant_message)
-    with st.chat_message("assistant"):
-        st.markdown(parsed.assistant_message)
+# Chat section runs as a fragment: sending a message reruns only this part,
+# not the sidebar or the blueprint panel
+@st.fragment
+def chat_fragment():
+    # Show conversation (older messages collapse into a single render)
+    older = st.session_state.messages[:-MESSAGE_WINDOW]
+    if older:
+        with st.expander(f"Earlier messages ({len(older)})"):
+            st.markdown("\n\n---\n\n".join(f"**{m['role']}:** {m['content']}" for m in older))
+    for m in st.session_state.messages[-MESSAGE_WINDOW:]:
+        with st.chat_message(m["role"]):
+            st.markdown(m["content"])
+
+    # Chat input
+    user_input = st.chat_input(st.session_state.tool_state.get("next_user_prompt", "Describe your idea."))
+
+    if user_input:
+        prev_state = st.session_state.tool_state
+        st.session_state.messages.append({"role": "user", "content": user_input})
+        user_entry = make_log_entry("user", user_input)
+        with st.chat_message("user"):
+            st.markdown(user_input)
+
+        with st.chat_message("assistant"):
+            parsed = call_ai(user_input, st.empty())
+        st.session_state.tool_state = parsed.state.model_dump(mode="python")
+
+        if parsed.blueprint_md:
+            bp = parsed.blueprint_md
+            if st.session_state.tool_state.get("mode") == "BUILDER":
+                submit_scan(bp)
+            set_blueprint(bp)
+
+        st.session_state.messages.append({"role": "assistant", "content": parsed.assistant_message})
+        log_batch_to_gsheet([user_entry, make_log_entry("assistant", parsed.assistant_message)])
+        save_session()
+
+        # Only the chat reran; refresh the whole app if the sidebar or
+        # blueprint panel now shows stale data
+        if st.session_state.tool_state != prev_state or parsed.blueprint_md:
+            st.rerun()
+
+chat_fragment()
 
 # Blueprint output
 st.divider()
@@ -250,10 +453,12 @@ with left:
     if st.session_state.blueprint_md:
         st.download_button(
             "Download blueprint.md",
-            st.session_state.blueprint_md.encode(),
+            st.session_state.blueprint_md_bytes,
             "blueprint.md",
         )
         st.code(st.session_state.blueprint_md, language="markdown")
+        if st.session_state.pending_scan:
+            st.caption("Running consistency check…")
     else:
         st.info("Blueprint appears after Builder Mode.")
 
@@ -265,3 +470,12 @@ with right:
         "• Say what feels wrong\n"
         "• Stop when blueprint appears"
     )
+
+# The page is already on screen; wait briefly for the background scan and
+# rerun so its result is merged without user action. Each wait is short so
+# chat submits and Reset clicks are picked up while the scan runs.
+# The caption under the blueprint is the progress indicator; a spinner would
+# not get past its own display delay within one short wait.
+if st.session_state.pending_scan:
+    wait([st.session_state.pending_scan], timeout=SCAN_POLL_SECONDS)
+    st.rerun()